@@ -68,10 +68,14 @@ def main(config):
         args.multiprocessing_distributed = False
     if args.multiprocessing_distributed:
         args.sync_bn = True
-        port = utils.find_free_port()
+        # hold the port until the workers are done so no other process can grab it
+        port, port_sock = utils.find_free_port(return_socket=True)
         args.dist_url = args.dist_url.format(port)
         args.world_size = args.ngpus_per_node * args.world_size
-        mp.spawn(main_worker, nprocs=args.ngpus_per_node, args=(args.ngpus_per_node, args))
+        try:
+            mp.spawn(main_worker, nprocs=args.ngpus_per_node, args=(args.ngpus_per_node, args))
+        finally:
+            port_sock.close()
     else:
         main_worker(args.train_gpu, args.ngpus_per_node, args)
 
@@ -348,6 +352,7 @@ def main_worker(gpu, ngpus_per_node, argss):
             torch.save(ckpt, filename)
         if utils.is_main_process():
             writer.flush()
+            utils.flush_logs()
 
     if utils.is_main_process():
         logger.close()
@@ -414,28 +419,31 @@ def train(train_loader, model, optimizer, lr_scheduler, epoch, args):
                     assert len(boxes_list_i) == args.n_train_way * args.n_query
                     query_boxes[ii] = boxes_list_i[query_dix:query_dix+1]
 
-        with torch.cuda.amp.autocast(enabled=args.amp):
-            if shot_boxes is not None and query_boxes is not None:
-                logits = model(
-                    x_shot,
-                    x_query,
-                    shot_boxes=shot_boxes,
-                    query_boxes=query_boxes,
-                    shot_boxes_dim=shot_boxes_dim,
-                    query_boxes_dim = query_boxes_dim
-                ).view(-1, args.n_train_way)
-            else:
-                logits = model(x_shot, x_query).view(-1, args.n_train_way)
-            loss = F.cross_entropy(logits, label_query)
-            acc = utils.compute_acc(logits, label_query)
-
-
-        optimizer.zero_grad()
-        loss.backward()
+        # with DDP, micro-batches that only accumulate skip the gradient all-reduce;
+        # no_sync has to cover the forward as well as the backward
+        accumulating = getattr(optimizer, 'next_step_accumulates', False)
+        with utils.no_sync_if_accumulating(model, accumulating):
+            with torch.cuda.amp.autocast(enabled=args.amp):
+                if shot_boxes is not None and query_boxes is not None:
+                    logits = model(
+                        x_shot,
+                        x_query,
+                        shot_boxes=shot_boxes,
+                        query_boxes=query_boxes,
+                        shot_boxes_dim=shot_boxes_dim,
+                        query_boxes_dim = query_boxes_dim
+                    ).view(-1, args.n_train_way)
+                else:
+                    logits = model(x_shot, x_query).view(-1, args.n_train_way)
+                loss = F.cross_entropy(logits, label_query)
+                acc = utils.compute_acc(logits, label_query)
+
+            optimizer.zero_grad()
+            loss.backward()
         optimizer.step()
 
         lrs = lr_scheduler.get_last_lr()
-        if not args.update_lr_every_epoch:
+        if not args.update_lr_every_epoch and not getattr(optimizer, 'accumulating', False):
             lr_scheduler.step()
 
         n = logits.size(0)
@@ -480,6 +488,8 @@ def train(train_loader, model, optimizer, lr_scheduler, epoch, args):
                     lr=lrs[0]
                 )
             )
+            # keep log.txt current so the tail survives a killed job
+            utils.flush_logs()
 
     if utils.is_main_process():
         utils.log('Train result at epoch [{}/{}]: loss {:.4f}, acc {:.4f}.'.format(epoch, config['max_epoch'], loss_meter.avg, acc_meter.avg))
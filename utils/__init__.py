@@ -5,9 +5,13 @@
 # for Bongard-HOI. To view a copy of this license, see the LICENSE file.
 # ----------------------------------------------------------------------
 
+import atexit
+import contextlib
 import logging
 import os
 import shutil
+import tempfile
+import threading
 import time
 import math
 import warnings
@@ -17,6 +21,7 @@ import torch
 from torch import optim
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.modules.batchnorm import _BatchNorm
 from torch.optim import SGD, Adam, AdamW
 from torch.optim.lr_scheduler import MultiStepLR
 
@@ -31,9 +36,10 @@ from torch.utils.data import DataLoader
 import torch.distributed as dist
 import torch.nn as nn
 import functools
-from copy import deepcopy
+import inspect
 
 _log_path = None
+_log_files = {}
 
 _LOCAL_PROCESS_GROUP = None
 """
@@ -84,40 +90,91 @@ def _no_grad_trunc_normal_(tensor, mean, std, a, b):
 
 def trunc_normal_(tensor, mean=0., std=1., a=-2., b=2.):
     # type: (Tensor, float, float, float, float) -> Tensor
+    if hasattr(nn.init, 'trunc_normal_'):
+        # upstreamed in PyTorch 1.7
+        return nn.init.trunc_normal_(tensor, mean=mean, std=std, a=a, b=b)
     return _no_grad_trunc_normal_(tensor, mean, std, a, b)
 
 
 def div(numerator: Tensor, denom: Union[Tensor, int, float]) -> Tensor:
     """Handle division by zero"""
-    if type(denom) in [int, float]:
+    if isinstance(denom, (int, float)):
         if denom == 0:
             return torch.zeros_like(numerator)
         else:
             return numerator / denom
-    elif type(denom) is Tensor:
-        zero_idx = torch.nonzero(denom == 0).squeeze(1)
-        denom[zero_idx] += 1e-8
-        return numerator / denom
+    elif isinstance(denom, Tensor):
+        # branchless on device: no nonzero() sync and no in-place edit of `denom`
+        is_zero = denom == 0
+        safe_denom = torch.where(is_zero, torch.ones_like(denom), denom)
+        return torch.where(is_zero, torch.zeros_like(numerator), numerator / safe_denom)
     else:
         raise TypeError("Unsupported data type ", type(denom))
 
 
 class AverageMeter(object):
     """Computes and stores the average and current value"""
+    __slots__ = ('sum', 'n', 'val')
+
     def __init__(self):
         self.reset()
 
     def reset(self):
         self.val = 0
-        self.avg = 0
         self.sum = 0
-        self.count = 0
+        self.n = 0
 
     def update(self, val, n=1):
         self.val = val
         self.sum += val * n
-        self.count += n
-        self.avg = self.sum / self.count
+        self.n += n
+
+    # `Averager` interface
+    add = update
+
+    def batch_update(self, vals: Tensor, ns: Tensor):
+        """Accumulate several (value, count) pairs with one host sync"""
+        total, n = torch.stack([(vals * ns).sum(), ns.sum().to(vals.dtype)]).tolist()
+        self.sum += total
+        self.n += n
+
+    @property
+    def count(self):
+        return self.n
+
+    @property
+    def avg(self):
+        return self.sum / self.n if self.n else 0
+
+    def item(self):
+        return self.avg
+
+
+class MeterPool(object):
+    """
+    `n` AverageMeters stored as arrays (one per field) and addressed by index,
+    for when many meters are updated per step (e.g. per-layer profiling).
+    """
+    __slots__ = ('sum', 'count', 'val')
+
+    def __init__(self, n):
+        self.sum = np.zeros(n, dtype=np.float64)
+        self.count = np.zeros(n, dtype=np.float64)
+        self.val = np.zeros(n, dtype=np.float64)
+
+    def reset(self):
+        self.sum[:] = 0
+        self.count[:] = 0
+        self.val[:] = 0
+
+    def update(self, i, val, n=1):
+        self.val[i] = val
+        self.sum[i] += val * n
+        self.count[i] += n
+
+    def avg(self, i):
+        c = self.count[i]
+        return self.sum[i] / c if c else 0.0
 
 
 def set_log_path(path):
@@ -128,22 +185,22 @@ def set_log_path(path):
 def log(obj, filename='log.txt'):
     print(obj)
     if _log_path is not None:
-        with open(os.path.join(_log_path, filename), 'a') as f:
-            print(obj, file=f)
-
+        # keep log files open across calls; they are flushed by flush_logs() and closed at exit
+        path = os.path.join(_log_path, filename)
+        f = _log_files.get(path)
+        if f is None:
+            f = open(path, 'a', buffering=8192)
+            _log_files[path] = f
+            atexit.register(f.close)
+        print(obj, file=f)
 
-class Averager():
 
-    def __init__(self):
-        self.n = 0.0
-        self.v = 0.0
+def flush_logs():
+    for f in _log_files.values():
+        f.flush()
 
-    def add(self, v, n=1.0):
-        self.v = (self.v * self.n + v * n) / (self.n + n)
-        self.n += n
 
-    def item(self):
-        return self.v
+Averager = AverageMeter
 
 
 class Timer():
@@ -163,12 +220,34 @@ def set_gpu(gpu):
     os.environ['CUDA_VISIBLE_DEVICES'] = gpu
 
 
+def _rmtrees(paths):
+    for p in paths:
+        shutil.rmtree(p, ignore_errors=True)
+
+
 def ensure_path(path, remove=True):
     basename = os.path.basename(path.rstrip('/'))
     if os.path.exists(path):
         if remove and (basename.startswith('_')
                        or input('{} exists, remove? ([y]/n): '.format(path)) != 'n'):
-            shutil.rmtree(path)
+            # move the old tree aside and delete it in the background, so a
+            # large previous run doesn't hold up startup
+            parent = os.path.dirname(os.path.abspath(path.rstrip('/')))
+            trash_pattern = os.path.join(glob.escape(parent), glob.escape(basename) + '.trash.*')
+            # also pick up trash left behind by a run killed before its delete finished
+            stale = glob.glob(trash_pattern)
+            trash = tempfile.mkdtemp(prefix=basename + '.trash.', dir=parent)
+            try:
+                os.rename(path, os.path.join(trash, basename))
+            except OSError:
+                # e.g. `path` is a mount point: delete it synchronously instead
+                os.rmdir(trash)
+                shutil.rmtree(path)
+            else:
+                stale.append(trash)
+            if stale:
+                # not a daemon: interpreter exit waits for the delete to finish
+                threading.Thread(target=_rmtrees, args=(stale,)).start()
             os.makedirs(path)
     else:
         os.makedirs(path)
@@ -182,47 +261,130 @@ def time_str(t):
     return '{:.1f}s'.format(t)
 
 
+def _compile(fn=None, **kwargs):
+    """`torch.compile` where available and supported, otherwise a no-op"""
+    if fn is None:
+        return functools.partial(_compile, **kwargs)
+    if not hasattr(torch, 'compile'):  # PyTorch < 2.0
+        return fn
+    try:
+        import torch._dynamo
+        is_supported = getattr(torch._dynamo, 'is_dynamo_supported', lambda: True)
+        if not is_supported():  # e.g. Windows, or a Python newer than this PyTorch
+            return fn
+        return torch.compile(fn, **kwargs)
+    except Exception:
+        # some releases raise at decoration time on unsupported setups; this
+        # runs at import, so fall back to eager rather than break `import utils`
+        return fn
+
+
+def _l2_normalize(x):
+    # same as F.normalize(x, dim=-1): clamp the squared norm at eps ** 2 (eps=1e-12)
+    return x * (x * x).sum(dim=-1, keepdim=True).clamp_(min=1e-24).rsqrt_()
+
+
+def _gemm(input, feat, proto_t, beta, alpha):
+    # beta * input + alpha * feat @ proto_t, for both [N, D] and [B, N, D] inputs
+    if feat.dim() == 2:
+        return torch.addmm(input, feat, proto_t, beta=beta, alpha=alpha)
+    return torch.baddbmm(input, feat, proto_t, beta=beta, alpha=alpha)
+
+
+def _scale(temp):
+    # a python scalar temp is folded into the GEMM's alpha (or the sqr epilogue);
+    # a tensor temp (e.g. a learnable nn.Parameter) has to stay in the graph as a multiply
+    if isinstance(temp, (int, float)):
+        return temp, None
+    return 1.0, temp
+
+
+def _proto_side(proto, metric):
+    """
+    The prototype-side operands of the logits GEMM: the (normalized, for 'cos')
+    transposed prototypes [..., D, M] and, for 'sqr', their squared norms [..., 1, M].
+    """
+    if metric == 'cos':
+        # normalize once and hand the (b)mm a contiguous [..., D, M] operand
+        # rather than a strided transpose
+        return _l2_normalize(proto).transpose(-2, -1).contiguous(), None
+    if metric == 'sqr':
+        proto = proto.float()
+        return proto.transpose(-2, -1), (proto * proto).sum(dim=-1).unsqueeze(-2)
+    return proto.transpose(-2, -1), None
+
+
+@_compile(dynamic=False)
+def _logits_from_proto_side(feat, proto_t, proto_sq, metric, temp):
+    scale, rest = _scale(temp)
+    if metric == 'cos':
+        # normalize before the GEMM so both operands (and fp16 products under autocast) stay in [-1, 1]
+        feat = _l2_normalize(feat)
+    if metric == 'sqr':
+        # ||f - p||^2 = ||f||^2 + ||p||^2 - 2 f.p, without the N x M x D broadcast.
+        # The subtraction cancels catastrophically in fp16, so keep it in fp32 even
+        # under autocast, and clamp the rounding error that can push it below 0.
+        with torch.cuda.amp.autocast(enabled=False):
+            feat = feat.float()
+            sq_feat = (feat * feat).sum(dim=-1, keepdim=True)
+            sq_dist = _gemm(sq_feat + proto_sq, feat, proto_t.float(), beta=1, alpha=-2)
+        logits = sq_dist.clamp(min=0) * -scale
+    else:
+        logits = _gemm(feat.new_zeros(1), feat, proto_t, beta=0, alpha=scale)
+    return logits if rest is None else logits * rest
+
+
+_METRICS = ('dot', 'cos', 'sqr')
+
+
 def compute_logits(feat, proto, metric='dot', temp=1.0):
     assert feat.dim() == proto.dim()
+    assert feat.dim() in (2, 3)
+    assert metric in _METRICS
+    proto_t, proto_sq = _proto_side(proto, metric)
+    return _logits_from_proto_side(feat, proto_t, proto_sq, metric, temp)
 
-    if feat.dim() == 2:
-        if metric == 'dot':
-            logits = torch.mm(feat, proto.t())
-        elif metric == 'cos':
-            logits = torch.mm(F.normalize(feat, dim=-1),
-                              F.normalize(proto, dim=-1).t())
-        elif metric == 'sqr':
-            logits = -(feat.unsqueeze(1) -
-                       proto.unsqueeze(0)).pow(2).sum(dim=-1)
-
-    elif feat.dim() == 3:
-        if metric == 'dot':
-            logits = torch.bmm(feat, proto.permute(0, 2, 1))
-        elif metric == 'cos':
-            logits = torch.bmm(F.normalize(feat, dim=-1),
-                               F.normalize(proto, dim=-1).permute(0, 2, 1))
-        elif metric == 'sqr':
-            logits = -(feat.unsqueeze(2) -
-                       proto.unsqueeze(1)).pow(2).sum(dim=-1)
-
-    return logits * temp
+
+class PrototypeClassifier(object):
+    """
+    `compute_logits` against a fixed set of prototypes, e.g. across the query
+    batches of an evaluation loop: the prototype side (normalization, squared
+    norms, contiguous transpose) is computed once instead of on every call.
+    """
+
+    def __init__(self, proto, metric='dot', temp=1.0):
+        assert proto.dim() in (2, 3)
+        assert metric in _METRICS
+        self.metric = metric
+        self.temp = temp
+        proto_t, self.proto_sq = _proto_side(proto, metric)
+        self.proto_t = proto_t.contiguous()
+
+    def __call__(self, feat):
+        assert feat.dim() == self.proto_t.dim()
+        return _logits_from_proto_side(feat, self.proto_t, self.proto_sq,
+                                       self.metric, self.temp)
+
+
+@_compile(dynamic=True)
+def _acc_none(logits, label):
+    return (torch.argmax(logits, dim=1) == label).float()
+
+
+@_compile(dynamic=True)
+def _acc_mean(logits, label):
+    return (torch.argmax(logits, dim=1) == label).float().mean()
 
 
 def compute_acc(logits, label, reduction='mean'):
-    ret = (torch.argmax(logits, dim=1) == label).float()
     if reduction == 'none':
-        return ret.detach()
+        return _acc_none(logits, label).detach()
     elif reduction == 'mean':
-        return ret.mean()
+        return _acc_mean(logits, label)
 
 
 def compute_n_params(model, return_str=True):
-    tot = 0
-    for p in model.parameters():
-        w = 1
-        for x in p.shape:
-            w *= x
-        tot += w
+    tot = sum(p.numel() for p in model.parameters())
     if return_str:
         if tot >= 1e6:
             return '{:.1f}M'.format(tot / 1e6)
@@ -232,19 +394,120 @@ def compute_n_params(model, return_str=True):
         return tot
 
 
-def make_optimizer(params, name, max_steps, lr, weight_decay=None, milestones=None, scheduler='step', use_sam=False, sam_rho=0.005, eps=1e-8, **kwargs):
+def _param_tensors(params):
+    # `params` is a list of tensors or of param-group dicts
+    for p in params:
+        if not isinstance(p, dict):
+            yield p
+        elif isinstance(p['params'], Tensor):
+            yield p['params']
+        else:
+            yield from p['params']
+
+
+def _multi_tensor_kwargs(optim_cls, params):
+    """
+    Pick the fastest update implementation `optim_cls` supports on this PyTorch:
+    the fused kernel when every parameter is on CUDA, else the multi-tensor
+    (foreach) one, which works on any device. The two are mutually exclusive.
+    """
+    supported = inspect.signature(optim_cls.__init__).parameters
+    if 'fused' in supported and all(p.is_cuda for p in _param_tensors(params)):
+        return {'fused': True}
+    if 'foreach' in supported:
+        return {'foreach': True}
+    return {}
+
+
+class AccumulatingOptimizer(object):
+    """
+    Wrap an optimizer to accumulate gradients over `grad_accum_steps` micro-batches.
+
+    `zero_grad()` only clears gradients at the start of an accumulation window and
+    `step()` only updates the parameters (with the averaged gradients) at its end,
+    so the training loop can keep calling zero_grad/backward/step every iteration.
+    Per-iteration schedulers should only be stepped when `accumulating` is False.
+    With DDP, run the backward of micro-batches that won't step under
+    `model.no_sync()` to skip their gradient all-reduce.
+    """
+
+    def __init__(self, optimizer, grad_accum_steps):
+        assert grad_accum_steps >= 1
+        self.optimizer = optimizer
+        self.grad_accum_steps = grad_accum_steps
+        self._micro_step = 0
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    @property
+    def next_step_accumulates(self):
+        """Whether the next `step()` will only accumulate (i.e. not update the parameters)"""
+        return self._micro_step + 1 < self.grad_accum_steps
+
+    @property
+    def accumulating(self):
+        """Whether the gradients hold a partial window not yet applied by `step()`"""
+        return self._micro_step != 0
+
+    def zero_grad(self, *args, **kwargs):
+        if self._micro_step == 0:
+            self.optimizer.zero_grad(*args, **kwargs)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        self._micro_step += 1
+        if self._micro_step < self.grad_accum_steps:
+            return None
+        self._micro_step = 0
+        for group in self.optimizer.param_groups:
+            for p in group['params']:
+                if p.grad is not None:
+                    p.grad.div_(self.grad_accum_steps)
+        return self.optimizer.step(closure)
+
+    def state_dict(self):
+        return self.optimizer.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.optimizer.load_state_dict(state_dict)
+
+
+def make_optimizer(params, name, max_steps, lr, weight_decay=None, milestones=None, scheduler='step', use_sam=False, sam_rho=0.005, eps=1e-8, grad_accum_steps=1, **kwargs):
     if weight_decay is None:
         weight_decay = 0.
+    lr, eps = float(lr), float(eps)
+    # may be a generator (e.g. model.parameters()); it is read more than once below
+    params = [dict(p, params=list(p['params']))
+              if isinstance(p, dict) and not isinstance(p['params'], Tensor) else p
+              for p in params]
     if use_sam:
         optimizer = SAM(params, AdamW, rho=sam_rho, lr=lr, weight_decay=weight_decay, eps=1e-08)
     else:
         if name == 'sgd':
-            optimizer = SGD(params, lr, momentum=0.9, weight_decay=weight_decay)
+            optimizer = SGD(params, lr, momentum=0.9, weight_decay=weight_decay,
+                            **_multi_tensor_kwargs(SGD, params))
         elif name == 'adam':
-            optimizer = Adam(params, lr, weight_decay=weight_decay)
+            optimizer = Adam(params, lr, weight_decay=weight_decay,
+                             **_multi_tensor_kwargs(Adam, params))
         elif name == 'adamw':
             optimizer = AdamW(
-                params, float(lr), betas=(0.9, 0.999), eps=float(eps),
+                params, lr, betas=(0.9, 0.999), eps=eps,
+                weight_decay=weight_decay, **_multi_tensor_kwargs(AdamW, params)
+            )
+        elif name == 'adafactor':
+            # factored second moment: O(n + m) optimizer state per n x m weight
+            from transformers import Adafactor
+            optimizer = Adafactor(
+                params, lr=lr, scale_parameter=False, relative_step=False,
+                warmup_init=False, weight_decay=weight_decay
+            )
+        elif name == 'adamw8bit':
+            # 8-bit quantized Adam moments
+            import bitsandbytes as bnb
+            optimizer = bnb.optim.AdamW8bit(
+                params, lr=lr, betas=(0.9, 0.999), eps=eps,
                 weight_decay=weight_decay
             )
 
@@ -258,7 +521,7 @@ def make_optimizer(params, name, max_steps, lr, weight_decay=None, milestones=No
         lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(
 			optimizer,
 			lr,
-			max_steps + 100,
+			max_steps // grad_accum_steps + 100,
         	pct_start=0.05,
 			cycle_momentum=False,
 			anneal_strategy='linear',
@@ -268,35 +531,43 @@ def make_optimizer(params, name, max_steps, lr, weight_decay=None, milestones=No
     elif scheduler == 'warmup_cosine':
         import pl_bolts
         lr_scheduler = pl_bolts.optimizers.lr_scheduler.LinearWarmupCosineAnnealingLR(optimizer, kwargs['warmup_epochs'], kwargs['max_epochs'], warmup_start_lr=kwargs['warmup_start_lr'], eta_min=0.0, last_epoch=-1)
+    if grad_accum_steps > 1:
+        # schedulers are bound to the inner optimizer, so they see real updates only
+        optimizer = AccumulatingOptimizer(optimizer, grad_accum_steps)
     return optimizer, lr_scheduler, update_lr_every_epoch
 
 
-def visualize_dataset(dataset, name, writer, n_samples=1):
-    def get_data(dataset, i):
-        if dataset.use_moco:
-            return dataset.convert_raw(dataset[i][0][0])
-        else:
-            return dataset.convert_raw(dataset[i][0])
+def _collate_raw(dataset, samples):
+    if dataset.use_moco:
+        return torch.stack([dataset.convert_raw(x[0][0]) for x in samples])
+    else:
+        return torch.stack([dataset.convert_raw(x[0]) for x in samples])
+
+
+def visualize_dataset(dataset, name, writer, n_samples=1, num_workers=4):
+    collate_fn = functools.partial(_collate_raw, dataset)
 
     for task_id in np.random.choice(dataset.n_tasks, n_samples, replace=False):
         pos_indices = [task_id * dataset.bong_size * 2 + i
                        for i in range(dataset.bong_size)]
-        data_per_task_pos = torch.stack([get_data(dataset, i)
-                                         for i in pos_indices])
         neg_indices = [task_id * dataset.bong_size * 2 + i + dataset.bong_size
                        for i in range(dataset.bong_size)]
-        data_per_task_neg = torch.stack([get_data(dataset, i)
-                                         for i in neg_indices])
+        # one sample per batch so the decoding is spread over the workers,
+        # then split the task back into pos/neg
+        subset = torch.utils.data.Subset(dataset, pos_indices + neg_indices)
+        loader = DataLoader(subset, batch_size=1, num_workers=num_workers,
+                            collate_fn=collate_fn)
+        data_per_task = torch.cat(list(loader))
+        data_per_task_pos, data_per_task_neg = data_per_task.split(
+            [len(pos_indices), len(neg_indices)])
 
         if name is None:
             name = os.path.basename(dataset.tasks[task_id])
         else:
             name += '_' + os.path.basename(dataset.tasks[task_id])
         # stack 'L' to 'RGB' for visualization
-        data_per_task_pos = torch.cat(
-            [data_per_task_pos, data_per_task_pos, data_per_task_pos], dim=1)
-        data_per_task_neg = torch.cat(
-            [data_per_task_neg, data_per_task_neg, data_per_task_neg], dim=1)
+        data_per_task_pos = data_per_task_pos.expand(-1, 3, -1, -1)
+        data_per_task_neg = data_per_task_neg.expand(-1, 3, -1, -1)
         writer.add_images('visualize_' + name + '_task' + str(task_id) + '/pos',
                           data_per_task_pos)
         writer.add_images('visualize_' + name + '_task' + str(task_id) + '/neg',
@@ -305,9 +576,22 @@ def visualize_dataset(dataset, name, writer, n_samples=1):
 
 
 def freeze_bn(model):
-    for m in model.modules():
-        if isinstance(m, nn.BatchNorm2d):
-            m.eval()
+    """
+    Put every BatchNorm layer of `model` in eval mode. The layers are collected
+    on the first call and cached on the model, so the model's BN layers must not
+    change afterwards (e.g. by `nn.SyncBatchNorm.convert_sync_batchnorm`)
+    unless `reset_freeze_bn_cache(model)` is called after the change.
+    """
+    bns = getattr(model, '_bn_modules', None)
+    if bns is None:
+        bns = [m for m in model.modules() if isinstance(m, _BatchNorm)]
+        model._bn_modules = bns
+    for m in bns:
+        m.eval()
+
+
+def reset_freeze_bn_cache(model):
+    model.__dict__.pop('_bn_modules', None)
 
 
 class Logger(object):
@@ -320,9 +604,10 @@ class Logger(object):
         self.file = None
 
         if file_name is not None:
-            self.file = open(file_name, file_mode)
+            self.file = open(file_name, file_mode, buffering=65536)
 
         self.should_flush = should_flush
+        self._unflushed = 0
         self.stdout = sys.stdout
         self.stderr = sys.stderr
 
@@ -336,7 +621,7 @@ class Logger(object):
         self.close()
 
     def write(self, text: str) -> None:
-        """Write text to stdout (and a file) and optionally flush."""
+        """Write text to stdout (and a file) and optionally flush, once per line or 4 KB."""
         if len(text) == 0:  # workaround for a bug in VSCode debugger: sys.stdout.write(''); sys.stdout.flush() => crash
             return
 
@@ -346,10 +631,15 @@ class Logger(object):
         self.stdout.write(text)
 
         if self.should_flush:
-            self.flush()
+            # partial-line writes (e.g. print(..., end='')) don't each pay for a flush
+            self._unflushed += len(text)
+            if '\n' in text or self._unflushed > 4096:
+                self.flush()
 
     def flush(self) -> None:
         """Flush written text to both stdout and a file, if open."""
+        self._unflushed = 0
+
         if self.file is not None:
             self.file.flush()
 
@@ -368,25 +658,29 @@ class Logger(object):
         if self.file is not None:
             self.file.close()
 
+@functools.lru_cache(maxsize=None)
+def _parse_str(s):
+    # try int
+    try:
+        ret = int(s)
+    except:
+        # try bool
+        if s.lower() in ('true', 'false'):
+            ret = s.lower() == 'true'
+        # try float
+        else:
+            try:
+                ret = float(s)
+            except:
+                ret = s
+    return ret
+
 def anytype2bool_dict(s):
     # check str
     if not isinstance(s, str):
         return s
     else:
-        # try int
-        try:
-            ret = int(s)
-        except:
-            # try bool
-            if s.lower() in ('true', 'false'):
-                ret = s.lower() == 'true'
-            # try float
-            else:
-                try:
-                    ret = float(s)
-                except:
-                    ret = s
-        return ret
+        return _parse_str(s)
 
 def parse_string_to_dict(field_name, value):
     fields = field_name.split('.')
@@ -395,47 +689,73 @@ def parse_string_to_dict(field_name, value):
         value = res
     return res
 
-def merge_to_dicts(a, b):
-    if isinstance(b, dict) and isinstance(a, dict):
-        a_and_b = set(a.keys()) & set(b.keys())
-        every_key = set(a.keys()) | set(b.keys())
-        return {k: merge_to_dicts(a[k], b[k]) if k in a_and_b else
-                   deepcopy(a[k] if k in a else b[k]) for k in every_key}
-    return deepcopy(type(a)(b))
+def _merge_inplace(a, b):
+    # merge b into a, only touching the leaves that b overrides
+    for k, v in b.items():
+        if isinstance(v, dict) and isinstance(a.get(k), dict):
+            _merge_inplace(a[k], v)
+        elif k in a:
+            a[k] = type(a[k])(v)
+        else:
+            a[k] = v
+    return a
 
 def override_cfg_from_list(cfg, opts):
     assert len(opts) % 2 == 0, 'Paired input must be provided to override config, opts: {}'.format(opts)
     for ix in range(0, len(opts), 2):
         opts_dict = parse_string_to_dict(opts[ix], opts[ix + 1])
-        cfg = merge_to_dicts(cfg, opts_dict)
+        _merge_inplace(cfg, opts_dict)
     return cfg
 
 # ----------------------------------------------------------------------------
 
-def find_free_port():
+def find_free_port(return_socket=False):
     import socket
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # let the process that rendezvouses on this port (e.g. the TCPStore of
+    # `init_process_group`) bind it while we still hold it
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     # Binding to port 0 will cause the OS to find an available port for us
     sock.bind(("", 0))
     port = sock.getsockname()[1]
+    if return_socket:
+        # the port stays reserved until the caller closes `sock`
+        return port, sock
     sock.close()
     # NOTE: there is still a chance the port could be taken by other processes.
     return port
 
+# Filled in on first use once torch.distributed is initialized; the process
+# group layout doesn't change afterwards.
+_dist_cache = {}
+
+
+def _dist_initialized() -> bool:
+	return dist.is_available() and dist.is_initialized()
+
+
+def _reset_distributed_cache():
+	_dist_cache.clear()
+
+
 def get_world_size() -> int:
-	if not dist.is_available():
+	if 'world_size' in _dist_cache:
+		return _dist_cache['world_size']
+	if not _dist_initialized():
 		return 1
-	if not dist.is_initialized():
-		return 1
-	return dist.get_world_size()
+	_dist_cache['world_size'] = dist.get_world_size()
+	return _dist_cache['world_size']
 
 
 def get_rank() -> int:
-	if not dist.is_available():
+	if 'rank' in _dist_cache:
+		return _dist_cache['rank']
+	if not _dist_initialized():
 		return 0
-	if not dist.is_initialized():
-		return 0
-	return dist.get_rank()
+	_dist_cache['rank'] = dist.get_rank()
+	return _dist_cache['rank']
 
 
 def get_local_rank() -> int:
@@ -443,12 +763,13 @@ def get_local_rank() -> int:
 	Returns:
 		The rank of the current process within the local (per-machine) process group.
 	"""
-	if not dist.is_available():
-		return 0
-	if not dist.is_initialized():
+	if 'local_rank' in _dist_cache:
+		return _dist_cache['local_rank']
+	if not _dist_initialized():
 		return 0
 	assert _LOCAL_PROCESS_GROUP is not None
-	return dist.get_rank(group=_LOCAL_PROCESS_GROUP)
+	_dist_cache['local_rank'] = dist.get_rank(group=_LOCAL_PROCESS_GROUP)
+	return _dist_cache['local_rank']
 
 
 def get_local_size() -> int:
@@ -457,11 +778,12 @@ def get_local_size() -> int:
 		The size of the per-machine process group,
 		i.e. the number of processes per machine.
 	"""
-	if not dist.is_available():
+	if 'local_size' in _dist_cache:
+		return _dist_cache['local_size']
+	if not _dist_initialized():
 		return 1
-	if not dist.is_initialized():
-		return 1
-	return dist.get_world_size(group=_LOCAL_PROCESS_GROUP)
+	_dist_cache['local_size'] = dist.get_world_size(group=_LOCAL_PROCESS_GROUP)
+	return _dist_cache['local_size']
 
 
 def is_main_process() -> bool:
@@ -481,3 +803,15 @@ def synchronize():
 	if world_size == 1:
 		return
 	dist.barrier()
+
+
+def no_sync_if_accumulating(model, accumulating: bool):
+	"""
+	Context manager skipping DDP's gradient all-reduce on gradient accumulation
+	micro-batches (`model.no_sync()`), and a no-op on steps that update the
+	parameters or for models without `no_sync` (e.g. DataParallel). It has to
+	wrap both the forward and the backward pass of the micro-batch.
+	"""
+	if accumulating and hasattr(model, 'no_sync'):
+		return model.no_sync()
+	return contextlib.nullcontext()